@@ -1,4 +1,5 @@
 from . import (
+    triton_quant,
     vanilla_quantizer,
     flexible_quantized_cache,
 )
\ No newline at end of file
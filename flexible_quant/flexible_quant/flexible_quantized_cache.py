@@ -3,7 +3,15 @@ from typing import Any, Dict, List, Optional, Tuple
 from transformers.cache_utils import DynamicCache, CacheConfig, QuantizedCacheConfig, is_optimum_quanto_available
 from transformers.utils import is_hqq_available
 
-from .vanilla_quantizer import VanillaQuantizer
+from .vanilla_quantizer import VanillaQuantizer, VanillaQuantizedTensor, quantize_int8_sym_per_token
+from .triton_quant import is_triton_available, dequantize_concat
+
+# C-implemented YAML loader when libyaml is available; per-layer/per-head configs can
+# hold thousands of entries for large models and the pure-Python loader is ~10x slower.
+try:
+    from yaml import CSafeLoader as _YamlLoader
+except ImportError:
+    from yaml import SafeLoader as _YamlLoader
 
 if is_hqq_available():
     from hqq.core.quantize import Quantizer as HQQQuantizer
@@ -23,7 +31,7 @@ class FlexibleQuantizedCacheConfig(QuantizedCacheConfig):
     Configuration for flexible quantized cache.
 
     Attributes:
-        backend (str): Backend for quantization. Options: "quanto", "hqq", "vanilla".
+        backend (str): Backend for quantization. Options: "quanto", "hqq", "vanilla", "fp8".
         nbits (Optional[int]): Precision for both key and value. Used if `nbits_key` and `nbits_value` are not set.
                                For per-layer or per-head quantization, set `nbits` to -1.
         nbits_key (Optional[int]): Precision for key quantization. For per-layer or per-head quantization, set to -1.
@@ -99,7 +107,7 @@ class FlexibleQuantizedCacheConfig(QuantizedCacheConfig):
             elif per_layer_config_path is not None:
                 import yaml
                 with open(per_layer_config_path, 'r') as f:
-                    self.per_layer_config = yaml.safe_load(f)
+                    self.per_layer_config = yaml.load(f, Loader=_YamlLoader)
             else:
                 raise ValueError("per_layer_quant is set to True but per_layer_config or per_layer_config_path is not provided.")
         self.per_head_quant = per_head_quant
@@ -109,11 +117,36 @@ class FlexibleQuantizedCacheConfig(QuantizedCacheConfig):
             elif per_head_config_path is not None:
                 import yaml
                 with open(per_head_config_path, 'r') as f:
-                    self.per_head_config = yaml.safe_load(f)
+                    self.per_head_config = yaml.load(f, Loader=_YamlLoader)
             else:
                 raise ValueError("per_head_quant is set to True but per_head_config or per_head_config_path is not provided.")
 
 
+def _c(tensor: torch.Tensor) -> torch.Tensor:
+    """Returns the tensor unchanged when already contiguous; torch.cat outputs and
+    index_select gathers usually are, so the guard skips the dispatch on the common path."""
+    return tensor if tensor.is_contiguous() else tensor.contiguous()
+
+
+def _assemble_kv(dequant: Optional[torch.Tensor], residual: Optional[torch.Tensor], new: Optional[torch.Tensor]) -> torch.Tensor:
+    """Concatenates the dequantized prefix, the residual and the new states along the
+    sequence axis, skipping the parts that are absent. The prefix is None while a
+    short prompt still lives entirely in the residual buffer."""
+    parts = [part for part in (dequant, residual, new) if part is not None]
+    if len(parts) == 1:
+        return parts[0]
+    return torch.cat(parts, dim=-2)
+
+
+# Trace-fuse the decode-step assembly when torch.compile is available; the quantizer
+# backends stay outside the graph, so this only covers the eager concat pipeline.
+if hasattr(torch, "compile"):
+    try:
+        _assemble_kv = torch.compile(_assemble_kv, dynamic=True)
+    except Exception:
+        pass
+
+
 class FlexibleQuantizedCache(DynamicCache):
     """
     A quantizer cache similar to what is described in the [KIVI: A Tuning-Free Asymmetric 2bit Quantization for KV Cache paper](https://arxiv.org/abs/2402.02750).
@@ -132,6 +165,17 @@ class FlexibleQuantizedCache(DynamicCache):
         super().__init__()
         self._quantized_key_cache: List[torch.Tensor] = []
         self._quantized_value_cache: List[torch.Tensor] = []
+        # Fixed-capacity residual buffers (one per layer) with a write pointer, so the
+        # decode path appends via strided writes instead of growing the residual with
+        # a fresh torch.cat allocation every token.
+        self._residual_key_buffer: List[Optional[torch.Tensor]] = []
+        self._residual_value_buffer: List[Optional[torch.Tensor]] = []
+        self._residual_len: List[int] = []
+        # Side CUDA stream for flush-time quantization, so the quantize of a full
+        # residual block overlaps with the next layer's attention instead of sitting
+        # on the critical path. Readers wait on the recorded per-layer event.
+        self._quant_stream = None
+        self._quant_events: Dict[int, Any] = {}
 
         self.nbits = cache_config.nbits
         self.nbits_key = cache_config.nbits_key
@@ -147,11 +191,28 @@ class FlexibleQuantizedCache(DynamicCache):
         self.per_layer_quant = cache_config.per_layer_quant
         if self.per_layer_quant:
             self.per_layer_config = cache_config.per_layer_config
+            # Flatten the per-layer dicts into plain integer lists so the hot path in
+            # update() does a single list index instead of two dict lookups per call.
+            self._nbits_key_per_layer = [self.per_layer_config[l]['nbits_key'] for l in sorted(self.per_layer_config)]
+            self._nbits_value_per_layer = [self.per_layer_config[l]['nbits_value'] for l in sorted(self.per_layer_config)]
         self.per_head_quant = cache_config.per_head_quant
         if self.per_head_quant:
             self.per_head_config = cache_config.per_head_config
-
-        super().__init__()
+            # Group heads sharing the same (nbits_key, nbits_value) so update() can
+            # quantize each group with a single batched call instead of a per-head loop.
+            self._per_head_groups = {}
+            for l, layer_config in self.per_head_config.items():
+                groups = {}
+                for head_idx, config in layer_config.items():
+                    groups.setdefault((config['nbits_key'], config['nbits_value']), []).append(head_idx)
+                self._per_head_groups[l] = {
+                    nbits: torch.tensor(head_idxs, dtype=torch.long) for nbits, head_idxs in groups.items()
+                }
+
+        # Bind the branch once instead of re-evaluating the quantization-mode flags on
+        # every call; scalar and per-layer share the dense body since the nbits tables
+        # reduced their difference to a single list index.
+        self._update_impl = self._update_per_head if self.per_head_quant else self._update_dense
 
     def update(
         self,
@@ -166,111 +227,221 @@ class FlexibleQuantizedCache(DynamicCache):
             self._seen_tokens += key_states.shape[-2]
         if len(self.key_cache) < layer_idx:
             raise ValueError("QuantizedCache does not support model usage where layers are skipped. Use DynamicCache.")
+        # Number of prefill tokens kept unquantized on the force_quant path; 0 means the
+        # sequence is an exact multiple of residual_length and everything is quantized.
+        tokens_to_keep = key_states.shape[-2] % self.residual_length if self.residual_length else 0
+        return self._update_impl(key_states, value_states, layer_idx, tokens_to_keep)
+
+    def _update_dense(self, key_states, value_states, layer_idx, tokens_to_keep):
+        nbits_key = self.nbits_key if not self.per_layer_quant else self._nbits_key_per_layer[layer_idx]
+        nbits_value = self.nbits_value if not self.per_layer_quant else self._nbits_value_per_layer[layer_idx]
+        if len(self.key_cache) == layer_idx:
+            self._append_layer_residual(key_states, value_states)
+            # None placeholders keep the DynamicCache layer lists aligned without
+            # allocating empty tensors; the residual lives in the fixed buffers.
+            self.key_cache.append(None)
+            self.value_cache.append(None)
+            if self.force_quant:
+                # quirk: use dequantized key/value instead of original key/value
+                if tokens_to_keep:
+                    # keep tokens_to_keep by slicing the cache in axis -2
+                    self._quantized_key_cache.append(self._quantize(key_states[..., :-tokens_to_keep, :], axis=self.axis_key, nbits=nbits_key))
+                    self._quantized_value_cache.append(self._quantize(value_states[..., :-tokens_to_keep, :], axis=self.axis_value, nbits=nbits_value))
+                    self._push_residual(layer_idx, key_states[..., -tokens_to_keep:, :], value_states[..., -tokens_to_keep:, :])
+                else:
+                    self._quantized_key_cache.append(self._quantize(key_states, axis=self.axis_key, nbits=nbits_key))
+                    self._quantized_value_cache.append(self._quantize(value_states, axis=self.axis_value, nbits=nbits_value))
+                keys_to_return = self._dequantize_and_concat(self._quantized_key_cache[layer_idx], self._residual_view(layer_idx, key=True), None)
+                values_to_return = self._dequantize_and_concat(self._quantized_value_cache[layer_idx], self._residual_view(layer_idx, key=False), None)
+            else:
+                if key_states.shape[-2] < self.residual_length:
+                    # The whole prompt fits in the residual buffer, so the quantized
+                    # tensor would never be read before the first flush re-quantizes
+                    # everything: skip the prefill quantize and stash the states raw.
+                    self._quantized_key_cache.append(None)
+                    self._quantized_value_cache.append(None)
+                    self._push_residual(layer_idx, key_states, value_states)
+                else:
+                    self._quantized_key_cache.append(self._quantize(_c(key_states), axis=self.axis_key, nbits=nbits_key))
+                    self._quantized_value_cache.append(self._quantize(_c(value_states), axis=self.axis_value, nbits=nbits_value))
+                keys_to_return, values_to_return = key_states, value_states
+        else:
+            self._wait_quant_event(layer_idx)
+            if self._needs_flush(layer_idx, key_states):
+                keys_to_return = self._dequantize_and_concat(self._quantized_key_cache[layer_idx], self._residual_view(layer_idx, key=True), key_states)
+                values_to_return = self._dequantize_and_concat(self._quantized_value_cache[layer_idx], self._residual_view(layer_idx, key=False), value_states)
+                self._run_flush_quant(
+                    layer_idx, keys_to_return, values_to_return,
+                    lambda k, v: (
+                        self._quantize(_c(k), axis=self.axis_key, nbits=nbits_key),
+                        self._quantize(_c(v), axis=self.axis_value, nbits=nbits_value),
+                    ),
+                )
+                self._residual_len[layer_idx] = 0
+            else:
+                self._push_residual(layer_idx, key_states, value_states)
+                keys_to_return = self._dequantize_and_concat(self._quantized_key_cache[layer_idx], self._residual_view(layer_idx, key=True), None)
+                values_to_return = self._dequantize_and_concat(self._quantized_value_cache[layer_idx], self._residual_view(layer_idx, key=False), None)
+        return keys_to_return, values_to_return
 
-        if not self.per_head_quant:
-            nbits_key = self.nbits_key if not self.per_layer_quant else self.per_layer_config[layer_idx]['nbits_key']
-            nbits_value = self.nbits_value if not self.per_layer_quant else self.per_layer_config[layer_idx]['nbits_value']
-            if len(self.key_cache) == layer_idx:
-                if self.force_quant:
-                    # quirk: use dequantized key/value instead of original key/value
-                    if self.residual_length:
-                        tokens_to_keep = key_states.shape[-2] % self.residual_length
-                        # keep tokens_to_keep by slicing the cache in axis -2
-                        self._quantized_key_cache.append(self._quantize(key_states[..., :-tokens_to_keep, :], axis=self.axis_key, nbits=nbits_key))
-                        self._quantized_value_cache.append(self._quantize(value_states[..., :-tokens_to_keep, :], axis=self.axis_value, nbits=nbits_value))
-                        self.key_cache.append(key_states[..., -tokens_to_keep:, :])
-                        self.value_cache.append(value_states[..., -tokens_to_keep:, :])
-                    else:
-                        self._quantized_key_cache.append(self._quantize(key_states, axis=self.axis_key, nbits=nbits_key))
-                        self._quantized_value_cache.append(self._quantize(value_states, axis=self.axis_value, nbits=nbits_value))
-                        self.key_cache.append(torch.zeros(0, dtype=key_states.dtype, device=key_states.device))
-                        self.value_cache.append(torch.zeros(0, dtype=key_states.dtype, device=key_states.device))
-                    keys_to_return = [self._dequantize(self._quantized_key_cache[layer_idx]), self.key_cache[layer_idx]]
-                    values_to_return = [self._dequantize(self._quantized_value_cache[layer_idx]), self.value_cache[layer_idx]]
-                    keys_to_return = torch.cat(keys_to_return, dim=-2)
-                    values_to_return = torch.cat(values_to_return, dim=-2)
+    def _update_per_head(self, key_states, value_states, layer_idx, tokens_to_keep):
+        assert key_states.dim() == 4 and value_states.dim() == 4
+        assert key_states.shape[1]  == value_states.shape[1]
+        if key_states.shape[1] != len(self.per_head_config[layer_idx]):
+            raise ValueError("Number of heads in the model does not match the number of heads in the per_head_config, you may loaded a invalid config file.")
+        head_groups = self._get_head_groups(layer_idx, key_states.device)
+        if len(self.key_cache) == layer_idx:
+            self._append_layer_residual(key_states, value_states)
+            # None placeholders keep the DynamicCache layer lists aligned without
+            # allocating empty tensors; the residual lives in the fixed buffers.
+            self.key_cache.append(None)
+            self.value_cache.append(None)
+            if self.force_quant:
+                if tokens_to_keep:
+                    self._quantized_key_cache.append(self._quantize_heads(key_states[..., :-tokens_to_keep, :], head_groups, axis=self.axis_key, key=True))
+                    self._quantized_value_cache.append(self._quantize_heads(value_states[..., :-tokens_to_keep, :], head_groups, axis=self.axis_value, key=False))
+                    self._push_residual(layer_idx, key_states[..., -tokens_to_keep:, :], value_states[..., -tokens_to_keep:, :])
                 else:
-                    self._quantized_key_cache.append(self._quantize(key_states.contiguous(), axis=self.axis_key, nbits=nbits_key))
-                    self._quantized_value_cache.append(self._quantize(value_states.contiguous(), axis=self.axis_value, nbits=nbits_value))
-                    self.key_cache.append(torch.zeros(0, dtype=key_states.dtype, device=key_states.device))
-                    self.value_cache.append(torch.zeros(0, dtype=key_states.dtype, device=key_states.device))
-                    keys_to_return, values_to_return = key_states, value_states
+                    self._quantized_key_cache.append(self._quantize_heads(key_states, head_groups, axis=self.axis_key, key=True))
+                    self._quantized_value_cache.append(self._quantize_heads(value_states, head_groups, axis=self.axis_value, key=False))
+                dequant_key = self._dequantize_heads(self._quantized_key_cache[layer_idx])
+                dequant_value = self._dequantize_heads(self._quantized_value_cache[layer_idx])
+                residual_key = self._residual_view(layer_idx, key=True)
+                residual_value = self._residual_view(layer_idx, key=False)
+                keys_to_return = _assemble_kv(dequant_key, residual_key, None)
+                values_to_return = _assemble_kv(dequant_value, residual_value, None)
             else:
-                dequant_key = self._dequantize(self._quantized_key_cache[layer_idx])
-                dequant_value = self._dequantize(self._quantized_value_cache[layer_idx])
-                keys_to_return = [dequant_key, self.key_cache[layer_idx], key_states]
-                values_to_return = [dequant_value, self.value_cache[layer_idx], value_states]
-
-                keys_to_return = torch.cat(keys_to_return, dim=-2)
-                values_to_return = torch.cat(values_to_return, dim=-2)
-                if (
-                    self.key_cache[layer_idx].dim() == 4
-                    and self.key_cache[layer_idx].shape[-2] + 1 >= self.residual_length
-                ):
-                    self._quantized_key_cache[layer_idx] = self._quantize(keys_to_return.contiguous(), axis=self.axis_key, nbits=nbits_key)
-                    self._quantized_value_cache[layer_idx] = self._quantize(
-                        values_to_return.contiguous(), axis=self.axis_value, nbits=nbits_value
-                    )
-                    self.key_cache[layer_idx] = torch.zeros(0, dtype=key_states.dtype, device=key_states.device)
-                    self.value_cache[layer_idx] = torch.zeros(0, dtype=key_states.dtype, device=key_states.device)
+                if key_states.shape[-2] < self.residual_length:
+                    # Same short-prompt shortcut as the dense path: the residual
+                    # buffer holds everything until the first flush.
+                    self._quantized_key_cache.append(None)
+                    self._quantized_value_cache.append(None)
+                    self._push_residual(layer_idx, key_states, value_states)
                 else:
-                    self.key_cache[layer_idx] = torch.cat([self.key_cache[layer_idx], key_states], dim=-2)
-                    self.value_cache[layer_idx] = torch.cat([self.value_cache[layer_idx], value_states], dim=-2)
-        else: # per head quant
-            assert key_states.dim() == 4 and value_states.dim() == 4
-            key_states, value_states = key_states.transpose(0, 1).contiguous(), value_states.transpose(0, 1).contiguous()
-            assert key_states.shape[0]  == value_states.shape[0]
-            if key_states.shape[0] != len(self.per_head_config[layer_idx]):
-                raise ValueError("Number of heads in the model does not match the number of heads in the per_head_config, you may loaded a invalid config file.")
-            keys_to_return, values_to_return = [], []
-            if len(self.key_cache) == layer_idx:
-                self._quantized_key_cache.append([])
-                self._quantized_value_cache.append([])
-                self.key_cache.append([])
-                self.value_cache.append([])
-                for head_idx, config in self.per_head_config[layer_idx].items():
-                    if self.force_quant:
-                        if self.residual_length:
-                            tokens_to_keep = key_states.shape[-2] % self.residual_length
-                            self._quantized_key_cache[layer_idx].append(self._quantize(key_states[head_idx][..., :-tokens_to_keep, :], axis=self.axis_key, nbits=config['nbits_key']))
-                            self._quantized_value_cache[layer_idx].append(self._quantize(value_states[head_idx][..., :-tokens_to_keep, :], axis=self.axis_value, nbits=config['nbits_value']))
-                            self.key_cache[layer_idx].append(key_states[head_idx][..., -tokens_to_keep:, :])
-                            self.value_cache[layer_idx].append(value_states[head_idx][..., -tokens_to_keep:, :])
-                        else:
-                            self._quantized_key_cache[layer_idx].append(self._quantize(key_states[head_idx], axis=self.axis_key, nbits=config['nbits_key']))
-                            self._quantized_value_cache[layer_idx].append(self._quantize(value_states[head_idx], axis=self.axis_value, nbits=config['nbits_value']))
-                            self.key_cache[layer_idx].append(torch.zeros(0, dtype=key_states.dtype, device=key_states.device))
-                            self.value_cache[layer_idx].append(torch.zeros(0, dtype=key_states.dtype, device=key_states.device))
-                        keys_to_return.append(torch.cat([self._dequantize(self._quantized_key_cache[layer_idx][-1]), self.key_cache[layer_idx][-1]], dim=-2))
-                        values_to_return.append(torch.cat([self._dequantize(self._quantized_value_cache[layer_idx][-1]), self.value_cache[layer_idx][-1]], dim=-2))
-                    else:
-                        self._quantized_key_cache[layer_idx].append(self._quantize(key_states[head_idx].contiguous(), axis=self.axis_key, nbits=config['nbits_key']))
-                        self._quantized_value_cache[layer_idx].append(self._quantize(value_states[head_idx].contiguous(), axis=self.axis_value, nbits=config['nbits_value']))
-                        self.key_cache[layer_idx].append(torch.zeros(0, dtype=key_states.dtype, device=key_states.device))
-                        self.value_cache[layer_idx].append(torch.zeros(0, dtype=key_states.dtype, device=key_states.device))
-                        keys_to_return.append(key_states[head_idx])
-                        values_to_return.append(value_states[head_idx])
+                    self._quantized_key_cache.append(self._quantize_heads(key_states, head_groups, axis=self.axis_key, key=True))
+                    self._quantized_value_cache.append(self._quantize_heads(value_states, head_groups, axis=self.axis_value, key=False))
+                keys_to_return, values_to_return = key_states, value_states
+        else:
+            self._wait_quant_event(layer_idx)
+            dequant_key = self._dequantize_heads(self._quantized_key_cache[layer_idx])
+            dequant_value = self._dequantize_heads(self._quantized_value_cache[layer_idx])
+            if self._needs_flush(layer_idx, key_states):
+                residual_key = self._residual_view(layer_idx, key=True)
+                residual_value = self._residual_view(layer_idx, key=False)
+                keys_to_return = _assemble_kv(dequant_key, residual_key, key_states)
+                values_to_return = _assemble_kv(dequant_value, residual_value, value_states)
+                self._run_flush_quant(
+                    layer_idx, keys_to_return, values_to_return,
+                    lambda k, v: (
+                        self._quantize_heads(_c(k), head_groups, axis=self.axis_key, key=True),
+                        self._quantize_heads(_c(v), head_groups, axis=self.axis_value, key=False),
+                    ),
+                )
+                self._residual_len[layer_idx] = 0
             else:
-                for head_idx, config in self.per_head_config[layer_idx].items():
-                    dequant_key = self._dequantize(self._quantized_key_cache[layer_idx][head_idx])
-                    dequant_value = self._dequantize(self._quantized_value_cache[layer_idx][head_idx])
-                    keys_to_return.append(torch.cat([dequant_key, self.key_cache[layer_idx][head_idx], key_states[head_idx]], dim=-2))
-                    values_to_return.append(torch.cat([dequant_value, self.value_cache[layer_idx][head_idx], value_states[head_idx]], dim=-2))
-                    if (
-                        self.key_cache[layer_idx][head_idx].dim() == 3
-                        and self.key_cache[layer_idx][head_idx].shape[-2] + 1 >= self.residual_length
-                    ):
-                        self._quantized_key_cache[layer_idx][head_idx] = self._quantize(keys_to_return[head_idx].contiguous(), axis=self.axis_key, nbits=config['nbits_key'])
-                        self._quantized_value_cache[layer_idx][head_idx] = self._quantize(values_to_return[head_idx].contiguous(), axis=self.axis_value, nbits=config['nbits_value'])
-                        self.key_cache[layer_idx][head_idx] = torch.zeros(0, dtype=key_states.dtype, device=key_states.device)
-                        self.value_cache[layer_idx][head_idx] = torch.zeros(0, dtype=key_states.dtype, device=key_states.device)
-                    else:
-                        self.key_cache[layer_idx][head_idx] = torch.cat([self.key_cache[layer_idx][head_idx], key_states[head_idx]], dim=-2)
-                        self.value_cache[layer_idx][head_idx] = torch.cat([self.value_cache[layer_idx][head_idx], value_states[head_idx]], dim=-2)
-            keys_to_return, values_to_return = torch.stack(keys_to_return), torch.stack(values_to_return)
-            keys_to_return, values_to_return = keys_to_return.transpose(0, 1).contiguous(), values_to_return.transpose(0, 1).contiguous()
+                self._push_residual(layer_idx, key_states, value_states)
+                keys_to_return = _assemble_kv(dequant_key, self._residual_view(layer_idx, key=True), None)
+                values_to_return = _assemble_kv(dequant_value, self._residual_view(layer_idx, key=False), None)
         return keys_to_return, values_to_return
 
+    def _run_flush_quant(self, layer_idx, keys_to_return, values_to_return, quantize_pair):
+        """
+        Stores the flush-time quantization of `(keys_to_return, values_to_return)` via
+        `quantize_pair(k, v) -> (qk, qv)`. On CUDA the quantize is issued on a side
+        stream with a recorded event so it overlaps with the next layer's attention;
+        the next reader of this layer waits on the event via `_wait_quant_event`.
+        """
+        if not keys_to_return.is_cuda:
+            self._quantized_key_cache[layer_idx], self._quantized_value_cache[layer_idx] = quantize_pair(keys_to_return, values_to_return)
+            return
+        if self._quant_stream is None:
+            self._quant_stream = torch.cuda.Stream()
+        self._quant_stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(self._quant_stream):
+            self._quantized_key_cache[layer_idx], self._quantized_value_cache[layer_idx] = quantize_pair(keys_to_return, values_to_return)
+            self._quant_events[layer_idx] = self._quant_stream.record_event()
+        # keep the allocator from recycling the sources before the side stream reads them
+        keys_to_return.record_stream(self._quant_stream)
+        values_to_return.record_stream(self._quant_stream)
+
+    def _wait_quant_event(self, layer_idx):
+        """Blocks the current stream on this layer's pending flush quantization, if any."""
+        event = self._quant_events.pop(layer_idx, None)
+        if event is not None:
+            torch.cuda.current_stream().wait_event(event)
+
+    def _append_layer_residual(self, key_states, value_states):
+        """Allocates the fixed-capacity `[B, H, residual_length, D]` residual buffer for a new layer."""
+        if self.residual_length:
+            shape = list(key_states.shape)
+            shape[-2] = self.residual_length
+            self._residual_key_buffer.append(torch.empty(shape, dtype=key_states.dtype, device=key_states.device))
+            self._residual_value_buffer.append(torch.empty(shape, dtype=value_states.dtype, device=value_states.device))
+        else:
+            self._residual_key_buffer.append(None)
+            self._residual_value_buffer.append(None)
+        self._residual_len.append(0)
+
+    def _push_residual(self, layer_idx, key_states, value_states):
+        """Writes new states into the residual buffer at the current write pointer."""
+        num_new = key_states.shape[-2]
+        ptr = self._residual_len[layer_idx]
+        self._residual_key_buffer[layer_idx][..., ptr:ptr + num_new, :] = key_states
+        self._residual_value_buffer[layer_idx][..., ptr:ptr + num_new, :] = value_states
+        self._residual_len[layer_idx] = ptr + num_new
+
+    def _residual_view(self, layer_idx, key: bool):
+        """Returns a zero-copy view of the valid residual tokens, or None when empty."""
+        if self._residual_len[layer_idx] == 0:
+            return None
+        buffer = self._residual_key_buffer[layer_idx] if key else self._residual_value_buffer[layer_idx]
+        return buffer[..., :self._residual_len[layer_idx], :]
+
+    def _needs_flush(self, layer_idx, key_states):
+        """Whether appending `key_states` would fill the residual buffer."""
+        if not self.residual_length:
+            return True
+        return self._residual_len[layer_idx] + key_states.shape[-2] >= self.residual_length
+
+    def _get_head_groups(self, layer_idx, device):
+        """Returns the per-nbits head index tensors for a layer, moved to `device` once."""
+        head_groups = self._per_head_groups[layer_idx]
+        if next(iter(head_groups.values())).device != device:
+            head_groups = {nbits: head_idxs.to(device) for nbits, head_idxs in head_groups.items()}
+            self._per_head_groups[layer_idx] = head_groups
+        return head_groups
+
+    def _quantize_heads(self, tensor, head_groups, axis, key: bool):
+        """
+        Quantizes a `[batch, num_heads, seq, head_dim]` tensor with one batched `_quantize`
+        call per (nbits_key, nbits_value) group. Returns a list of `(head_idxs, qtensor)` tuples.
+        For homogeneous configs this collapses to a single quantize over all heads.
+        """
+        quantized = []
+        for (nbits_key, nbits_value), head_idxs in head_groups.items():
+            nbits = nbits_key if key else nbits_value
+            # index_select already materializes a contiguous gather, so no extra
+            # .contiguous() copy is needed; a single group skips the gather entirely.
+            sub = tensor if len(head_groups) == 1 else tensor.index_select(1, head_idxs)
+            quantized.append((head_idxs, self._quantize(sub, axis=axis, nbits=nbits)))
+        return quantized
+
+    def _dequantize_heads(self, quantized):
+        """Dequantizes the per-group tensors produced by `_quantize_heads` and scatters them
+        back into a single `[batch, num_heads, seq, head_dim]` tensor along the head axis.
+        Returns None for a `None` entry (short-prompt prefill)."""
+        if quantized is None:
+            return None
+        parts = [(head_idxs, self._dequantize(qtensor)) for head_idxs, qtensor in quantized]
+        if len(parts) == 1:
+            return parts[0][1]
+        num_heads = sum(head_idxs.numel() for head_idxs, _ in parts)
+        first = parts[0][1]
+        out = first.new_empty((first.shape[0], num_heads) + first.shape[2:])
+        for head_idxs, dequant in parts:
+            out.index_copy_(1, head_idxs, dequant)
+        return out
+
     def get_seq_length(self, layer_idx: Optional[int] = 0) -> int:
         """Returns the sequence length of the cached states. A layer index can be optionally passed."""
         if len(self.key_cache) <= layer_idx:
@@ -280,6 +451,13 @@ class FlexibleQuantizedCache(DynamicCache):
         # this part of code otherwise fails when used to verify attn_weight shape in some models
         return self._seen_tokens if layer_idx == 0 else self._seen_tokens - 1
 
+    def _dequantize_and_concat(self, qtensor, residual, new):
+        """Dequantizes a cache entry and concatenates it with the residual and new states.
+        A `None` entry (short-prompt prefill) contributes nothing to the concat.
+        Backends may override this to fuse the dequantization with the concat."""
+        dequant = self._dequantize(qtensor) if qtensor is not None else None
+        return _assemble_kv(dequant, residual, new)
+
     def _quantize(self, tensor, axis, nbits):
         """Quantizes a key/value using a defined quantization method."""
         raise NotImplementedError("Make sure to implement `_quantize` in a subclass.")
@@ -320,7 +498,11 @@ class FlexibleQuantoQuantizedCache(FlexibleQuantizedCache):
         super().__init__(cache_config)
 
         if is_optimum_quanto_available():
-            from optimum.quanto import MaxOptimizer, qint2, qint4
+            from optimum.quanto import MaxOptimizer, quantize_weight, qint2, qint4, qint8
+            # Bind the quantization entry points once; _quantize runs per layer per
+            # token and should not pay the availability check + re-import each call.
+            self._quantize_weight = quantize_weight
+            self._qtype_by_nbits = {2: qint2, 4: qint4, 8: qint8}
         # elif is_quanto_available():
         #     logger.warning_once(
         #         "Importing from quanto will be deprecated in v4.47. Please install optimum-quanto instead `pip install optimum-quanto`"
@@ -348,34 +530,11 @@ class FlexibleQuantoQuantizedCache(FlexibleQuantizedCache):
         self.optimizer = MaxOptimizer()  # hardcode as it's the only one for per-channel quantization
     
     def get_qtype(self, nbits):
-        if is_optimum_quanto_available():
-            from optimum.quanto import qint2, qint4, qint8
-        # elif is_quanto_available():
-        #     from quanto import qint2, qint4, qint8
-        if nbits == 2:
-            return qint2
-        elif nbits == 4:
-            return qint4
-        elif nbits == 8:
-            return qint8
+        return self._qtype_by_nbits[nbits]
 
     def _quantize(self, tensor, axis, nbits):
         # We have two different API since in optimum-quanto, we don't use AffineQuantizer anymore
-        if is_optimum_quanto_available():
-            from optimum.quanto import quantize_weight
-
-            qtensor = quantize_weight(tensor, self.get_qtype(nbits), axis, self.q_group_size)
-            return qtensor
-        # elif is_quanto_available():
-        #     logger.warning_once(
-        #         "Importing from quanto will be deprecated in v4.47. Please install optimum-quanto instead `pip install optimum-quanto`"
-        #     )
-        #     from quanto import AffineQuantizer
-
-        #     scale, zeropoint = self.optimizer(tensor, nbits, axis, self.q_group_size)
-        #     qtensor = AffineQuantizer.apply(tensor, self.get_qtype(nbits), axis, self.q_group_size, scale, zeropoint)
-
-        return qtensor
+        return self._quantize_weight(tensor, self._qtype_by_nbits[nbits], axis, self.q_group_size)
 
     def _dequantize(self, qtensor):
         return qtensor.dequantize()
@@ -442,6 +601,38 @@ class FlexibleHQQQuantizedCache(FlexibleQuantizedCache):
         tensor = self.quantizer.dequantize(quant_tensor, meta)
         return tensor
 
+class FlexibleFP8QuantizedCache(FlexibleQuantizedCache):
+    """
+    Quantized Cache class that stores keys and values as `float8_e4m3fn` with a single
+    per-head FP32 scale. Unlike the integer backends there is no group-wise metadata:
+    FP8 halves the cache bandwidth versus FP16 while the stored tensor stays directly
+    consumable by FP8 attention kernels. `nbits` settings are ignored; every layer and
+    head is stored at 8 bits. Requires a torch build with `float8_e4m3fn`.
+
+    Parameters:
+        cache_config (`QuantizedCacheConfig`):
+            A configuration containing all the arguments to be used by the quantizer.
+    """
+
+    # largest finite magnitude representable in float8_e4m3fn
+    FP8_E4M3_MAX = 448.0
+
+    def __init__(self, cache_config: CacheConfig) -> None:
+        super().__init__(cache_config)
+        if not hasattr(torch, "float8_e4m3fn"):
+            raise ValueError("`fp8` backend requires a torch build with `float8_e4m3fn` support.")
+
+    def _quantize(self, tensor, axis, nbits):
+        amax = tensor.abs().amax(dim=(-2, -1), keepdim=True).clamp(min=1e-5)
+        scale = (amax / self.FP8_E4M3_MAX).to(torch.float32)
+        qtensor = (tensor / scale).to(torch.float8_e4m3fn)
+        return qtensor, scale
+
+    def _dequantize(self, qtensor):
+        quant_tensor, scale = qtensor
+        return quant_tensor.to(self.compute_dtype).mul_(scale.to(self.compute_dtype))
+
+
 class FlexibleVanillaQuantizedCache(FlexibleQuantizedCache):
     def __init__(self, cache_config: CacheConfig) -> None:
         super().__init__(cache_config)
@@ -455,11 +646,22 @@ class FlexibleVanillaQuantizedCache(FlexibleQuantizedCache):
         self.quantilizers = {}
 
     def _quantize(self, tensor, axis, nbits):
+        if nbits == 8 and not self.asym and axis == 0 and self.q_group_size == -1:
+            # Per-token symmetric INT8: one amax reduction and a fused round/cast,
+            # no quantilizer object or group reshape needed.
+            return quantize_int8_sym_per_token(tensor, self.compute_dtype)
         if (nbits, axis) not in self.quantilizers:
             self.quantilizers[(nbits, axis)] = VanillaQuantizer(nbits, self.asym, self.compute_dtype)
-        quantilizer = self.quantilizers[(nbits, axis)]        
+        quantilizer = self.quantilizers[(nbits, axis)]
         return quantilizer.quantize(tensor, self.q_group_size, axis)
-    
+
     def _dequantize(self, qtensor):
         return qtensor.dequantize()
+
+    def _dequantize_and_concat(self, qtensor, residual, new):
+        if isinstance(qtensor, VanillaQuantizedTensor) and is_triton_available(qtensor.tensor):
+            out = dequantize_concat(qtensor, residual, new, self.compute_dtype)
+            if out is not None:
+                return out
+        return super()._dequantize_and_concat(qtensor, residual, new)
     
\ No newline at end of file
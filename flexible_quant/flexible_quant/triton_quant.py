@@ -0,0 +1,164 @@
+import torch
+
+try:
+    import triton
+    import triton.language as tl
+    _TRITON_AVAILABLE = True
+except ImportError:
+    _TRITON_AVAILABLE = False
+
+
+def is_triton_available(tensor: torch.Tensor) -> bool:
+    """Whether the fused Triton kernels can handle this tensor."""
+    return _TRITON_AVAILABLE and tensor.is_cuda
+
+
+if _TRITON_AVAILABLE:
+
+    @triton.jit
+    def _round(x):
+        # round-half-away-from-zero, stable across triton versions
+        return tl.where(x >= 0, tl.floor(x + 0.5), tl.ceil(x - 0.5))
+
+    @triton.jit
+    def _quant_group_kernel(
+        x_ptr, q_ptr, s_ptr, z_ptr,
+        Q_MAX: tl.constexpr, Q_MIN: tl.constexpr,
+        G: tl.constexpr, BLOCK: tl.constexpr, ASYM: tl.constexpr,
+    ):
+        # One program per quantization group: load the group, reduce min/max,
+        # compute scale (and zero-point for asym), quantize and store the int8
+        # tile plus the scale in a single pass over HBM.
+        pid = tl.program_id(0)
+        offs = tl.arange(0, BLOCK)
+        mask = offs < G
+        x = tl.load(x_ptr + pid * G + offs, mask=mask, other=0.0).to(tl.float32)
+        if ASYM:
+            _max = tl.max(tl.where(mask, x, float('-inf')), axis=0)
+            _min = tl.min(tl.where(mask, x, float('inf')), axis=0)
+            scale = tl.maximum(_max - _min, 1e-5) / (Q_MAX - Q_MIN)
+            zero = _round(_min / scale) - Q_MIN
+            q = _round(x / scale - zero)
+            tl.store(z_ptr + pid, zero)
+        else:
+            amax = tl.max(tl.where(mask, tl.abs(x), 0.0), axis=0)
+            scale = tl.maximum(amax, 1e-5) / Q_MAX
+            q = _round(x / scale)
+        q = tl.minimum(tl.maximum(q, Q_MIN), Q_MAX).to(tl.int8)
+        tl.store(q_ptr + pid * G + offs, q, mask=mask)
+        tl.store(s_ptr + pid, scale)
+
+    @triton.jit
+    def _dequant_into_kernel(
+        q_ptr, s_ptr, z_ptr, out_ptr,
+        rows_per_bh, groups_per_row, out_bh_stride,
+        G: tl.constexpr, BLOCK: tl.constexpr, ASYM: tl.constexpr, PACKED: tl.constexpr,
+    ):
+        # One program per quantization group, writing dequantized values directly
+        # into a strided slice of the final [B, H, T_full, D] tensor so the
+        # dequant output is never materialized separately and re-read by a concat.
+        pid = tl.program_id(0)
+        bh = pid // rows_per_bh
+        rem = pid % rows_per_bh
+        t = rem // groups_per_row
+        g = rem % groups_per_row
+        base = bh * out_bh_stride + t * (groups_per_row * G) + g * G
+        scale = tl.load(s_ptr + pid).to(tl.float32)
+        if ASYM:
+            zero = tl.load(z_ptr + pid).to(tl.float32)
+        else:
+            zero = 0.0
+        offs = tl.arange(0, BLOCK)
+        if PACKED:
+            mask = offs < G // 2
+            p = tl.load(q_ptr + pid * (G // 2) + offs, mask=mask, other=0).to(tl.int32)
+            low = ((p & 15) ^ 8) - 8
+            high = (((p >> 4) & 15) ^ 8) - 8
+            tl.store(out_ptr + base + 2 * offs, (low.to(tl.float32) + zero) * scale, mask=mask)
+            tl.store(out_ptr + base + 2 * offs + 1, (high.to(tl.float32) + zero) * scale, mask=mask)
+        else:
+            mask = offs < G
+            q = tl.load(q_ptr + pid * G + offs, mask=mask, other=0).to(tl.float32)
+            tl.store(out_ptr + base + offs, (q + zero) * scale, mask=mask)
+
+    @triton.jit
+    def _dequant_group_kernel(
+        q_ptr, s_ptr, z_ptr, out_ptr,
+        G: tl.constexpr, BLOCK: tl.constexpr, ASYM: tl.constexpr,
+    ):
+        pid = tl.program_id(0)
+        offs = tl.arange(0, BLOCK)
+        mask = offs < G
+        q = tl.load(q_ptr + pid * G + offs, mask=mask, other=0).to(tl.float32)
+        scale = tl.load(s_ptr + pid).to(tl.float32)
+        if ASYM:
+            zero = tl.load(z_ptr + pid).to(tl.float32)
+            x = (q + zero) * scale
+        else:
+            x = q * scale
+        tl.store(out_ptr + pid * G + offs, x, mask=mask)
+
+
+def quantize_groups(rs: torch.Tensor, nbits: int, asym: bool):
+    """
+    Quantizes a contiguous `[n_groups, group_size]` tensor in one fused kernel.
+    Returns `(quant int8, scale, zeros)` matching the eager quant_sym/quant_asym layout;
+    `zeros` is None for symmetric quantization.
+    """
+    n_groups, group_size = rs.shape
+    quant = torch.empty_like(rs, dtype=torch.int8)
+    scale = torch.empty(n_groups, dtype=rs.dtype, device=rs.device)
+    zeros = torch.empty(n_groups, dtype=rs.dtype, device=rs.device) if asym else None
+    q_max, q_min = 2 ** (nbits - 1) - 1, -2 ** (nbits - 1)
+    _quant_group_kernel[(n_groups,)](
+        rs, quant, scale, zeros if asym else scale,
+        Q_MAX=q_max, Q_MIN=q_min,
+        G=group_size, BLOCK=triton.next_power_of_2(group_size), ASYM=asym,
+    )
+    return quant, scale, zeros
+
+
+def dequantize_concat(qtensor, residual, new, target_dtype: torch.dtype):
+    """
+    Fuses dequantization with the [dequant, residual, new] concat: allocates the full
+    output once and streams dequantized values straight into its leading slice, then
+    copies the residual and new states into the tail. Supports per-token (axis 0)
+    4-D layouts whose group size divides head_dim; returns None when the layout is
+    unsupported so the caller can fall back to the eager dequant + concat path.
+    """
+    if qtensor.axis != 0 or len(qtensor.original_shape) != 4:
+        return None
+    batch, num_heads, t_quant, head_dim = qtensor.original_shape
+    quant = qtensor.tensor
+    group_size = quant.shape[-1] * (2 if qtensor.packed else 1)
+    if head_dim % group_size != 0 or (qtensor.packed and group_size % 2 != 0):
+        return None
+    t_residual = residual.shape[-2] if residual is not None else 0
+    t_new = new.shape[-2] if new is not None else 0
+    t_full = t_quant + t_residual + t_new
+    out = torch.empty((batch, num_heads, t_full, head_dim), dtype=target_dtype, device=quant.device)
+    groups_per_row = head_dim // group_size
+    asym = qtensor.zeros is not None
+    block = group_size // 2 if qtensor.packed else group_size
+    _dequant_into_kernel[(quant.shape[0],)](
+        quant, qtensor.scaling, qtensor.zeros if asym else qtensor.scaling, out,
+        rows_per_bh=t_quant * groups_per_row, groups_per_row=groups_per_row,
+        out_bh_stride=t_full * head_dim,
+        G=group_size, BLOCK=triton.next_power_of_2(max(block, 1)), ASYM=asym, PACKED=qtensor.packed,
+    )
+    if t_residual:
+        out[..., t_quant:t_quant + t_residual, :] = residual
+    if t_new:
+        out[..., t_quant + t_residual:, :] = new
+    return out
+
+
+def dequantize_groups(quant: torch.Tensor, scale: torch.Tensor, zeros, target_dtype: torch.dtype):
+    """Dequantizes the output of `quantize_groups` in one fused multiply-add kernel."""
+    n_groups, group_size = quant.shape
+    out = torch.empty(quant.shape, dtype=target_dtype, device=quant.device)
+    _dequant_group_kernel[(n_groups,)](
+        quant, scale, zeros if zeros is not None else scale, out,
+        G=group_size, BLOCK=triton.next_power_of_2(group_size), ASYM=zeros is not None,
+    )
+    return out
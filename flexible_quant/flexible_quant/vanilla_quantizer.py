@@ -1,22 +1,48 @@
 
 import torch
 
+from .triton_quant import is_triton_available, quantize_groups, dequantize_groups
 
-def quant_sym(x: torch.tensor, scaling: torch.tensor, nbits: int):
+
+def quant_sym(x: torch.Tensor, scaling: torch.Tensor, nbits: int) -> torch.Tensor:
     q_max, q_min = 2 ** (nbits - 1) - 1, -2 ** (nbits - 1)
-    return torch.round(x / scaling.unsqueeze(1)).clip(q_min, q_max).to(torch.int8)
+    return torch.round(x / scaling.unsqueeze(1)).clamp(q_min, q_max).to(torch.int8)
 
-def dequant_sym(x: torch.tensor, scaling: torch.tensor, target_dtype: torch.dtype):
+def dequant_sym(x: torch.Tensor, scaling: torch.Tensor, target_dtype: torch.dtype) -> torch.Tensor:
     return x * scaling.unsqueeze(1).to(target_dtype)
 
-def quant_asym(x: torch.tensor, scaling: torch.tensor, zeros: torch.tensor, nbits: int):
+def pack_int4(quant: torch.tensor):
+    """Packs an int8 tensor of 4-bit values (range [-8, 7]) into half the bytes,
+    two values per int8. The last dimension must be even."""
+    return (quant[..., 0::2] & 0xF) | (quant[..., 1::2] << 4)
+
+def unpack_int4(packed: torch.tensor):
+    """Inverse of `pack_int4`; sign-extends both nibbles via arithmetic shifts."""
+    out = torch.empty(packed.shape[:-1] + (packed.shape[-1] * 2,), dtype=torch.int8, device=packed.device)
+    out[..., 0::2] = (packed << 4) >> 4
+    out[..., 1::2] = packed >> 4
+    return out
+
+def quant_asym(x: torch.Tensor, scaling: torch.Tensor, zeros: torch.Tensor, nbits: int) -> torch.Tensor:
     q_max, q_min = 2 ** (nbits - 1) - 1, -2 ** (nbits - 1)
-    return (torch.round(x / scaling.unsqueeze(1) - zeros.unsqueeze(1))).clip(q_min, q_max).to(torch.int8)
-    
-def dequant_asym(x: torch.tensor, scaling: torch.tensor, zeros: torch.tensor, target_dtype: torch.dtype):
+    return (torch.round(x / scaling.unsqueeze(1) - zeros.unsqueeze(1))).clamp(q_min, q_max).to(torch.int8)
+
+def dequant_asym(x: torch.Tensor, scaling: torch.Tensor, zeros: torch.Tensor, target_dtype: torch.dtype) -> torch.Tensor:
     return (x + zeros.unsqueeze(1)) * scaling.unsqueeze(1).to(target_dtype)
 
 
+# Compile the scalar quant/dequant kernels with TorchScript so the eager fallback
+# path runs without per-op Python dispatch. update() itself cannot be scripted —
+# the quantizer backends are polymorphic — but these helpers are pure tensor math.
+try:
+    quant_sym = torch.jit.script(quant_sym)
+    dequant_sym = torch.jit.script(dequant_sym)
+    quant_asym = torch.jit.script(quant_asym)
+    dequant_asym = torch.jit.script(dequant_asym)
+except Exception:
+    pass
+
+
 class VanillaQuantizeMeta:
     def __init__(self, nbits, asym, compute_dtype):
         self.nbits = nbits
@@ -27,25 +53,51 @@ class VanillaQuantizeMeta:
 
     
 class VanillaQuantizedTensor:
-    def __init__(self, tensor, scaling, zeros, original_shape, axis, meta: VanillaQuantizeMeta):
+    def __init__(self, tensor, scaling, zeros, original_shape, axis, meta: VanillaQuantizeMeta, packed=False):
         self.tensor = tensor
         self.scaling = scaling
         self.zeros = zeros
         self.original_shape = original_shape
         self.axis = axis
         self.meta = meta
+        self.packed = packed
 
     def dequantize(self):
-        if self.meta.asym:
-            dequant = dequant_asym(self.tensor, self.scaling, self.zeros, self.meta.compute_dtype)
+        tensor = unpack_int4(self.tensor) if self.packed else self.tensor
+        if is_triton_available(tensor):
+            dequant = dequantize_groups(tensor, self.scaling, self.zeros, self.meta.compute_dtype)
+        elif self.meta.asym:
+            dequant = dequant_asym(tensor, self.scaling, self.zeros, self.meta.compute_dtype)
         else:
-            dequant = dequant_sym(self.tensor, self.scaling, self.meta.compute_dtype)
+            dequant = dequant_sym(tensor, self.scaling, self.meta.compute_dtype)
         dequant = dequant.view(self.original_shape)
         if self.axis == 1:
             max_dim = len(self.original_shape) - 1
             dequant = dequant.transpose(max_dim - 1, max_dim)
         return dequant
 
+class Int8SymQuantizedTensor:
+    """Result of the symmetric per-token INT8 fast path: a plain int8 tensor with one
+    scale per token row, dequantized with a single fused cast-and-multiply."""
+    def __init__(self, tensor, scaling, compute_dtype):
+        self.tensor = tensor
+        self.scaling = scaling
+        self.compute_dtype = compute_dtype
+
+    def dequantize(self):
+        return self.tensor.to(self.compute_dtype).mul_(self.scaling)
+
+
+def quantize_int8_sym_per_token(tensor: torch.tensor, compute_dtype: torch.dtype):
+    """
+    Symmetric per-token INT8 quantization: `scale = amax / 127` needs a single reduction
+    over the last dimension and no group reshape, unlike the general grouped path.
+    """
+    scale = tensor.abs().amax(dim=-1, keepdim=True).clamp(min=1e-5).div(127.0)
+    quant = torch.round(tensor / scale).clip(-128, 127).to(torch.int8)
+    return Int8SymQuantizedTensor(quant, scale, compute_dtype)
+
+
 class VanillaQuantizer:
     def __init__(self, nbits, asym, compute_dtype):
         self.meta = VanillaQuantizeMeta(nbits, asym, compute_dtype)
@@ -58,17 +110,28 @@ class VanillaQuantizer:
             assert axis == 0 # must be per-token
             q_group_size = tensor.shape[-1] # take the last dimension
         rs = tensor.reshape(-1, q_group_size)
-        
-        q_max, q_min = 2 ** (self.meta.nbits - 1) - 1, -2 ** (self.meta.nbits - 1)
-        
-        if self.meta.asym:
-            _max, _min = rs.max(dim=1).values, rs.min(dim=1).values
-            scale = (_max - _min).clamp(min=1e-5).div(q_max - q_min)
-            zeros = (_min / scale).round() - q_min
-            quant = quant_asym(rs, scale, zeros, self.meta.nbits)
+
+        if is_triton_available(rs):
+            # Fused reduce + scale + round + cast in a single pass over the tensor,
+            # instead of one memory-bound kernel per step.
+            quant, scale, zeros = quantize_groups(rs, self.meta.nbits, self.meta.asym)
         else:
-            scale = rs.abs().max(dim=1).values.clamp(min=1e-5).div(q_max)
-            zeros = None
-            quant = quant_sym(rs, scale, self.meta.nbits)
-        
-        return VanillaQuantizedTensor(quant, scale, zeros, tensor.shape, axis, self.meta)
+            q_max, q_min = 2 ** (self.meta.nbits - 1) - 1, -2 ** (self.meta.nbits - 1)
+
+            if self.meta.asym:
+                _max, _min = rs.max(dim=1).values, rs.min(dim=1).values
+                scale = (_max - _min).clamp(min=1e-5).div(q_max - q_min)
+                zeros = (_min / scale).round() - q_min
+                quant = quant_asym(rs, scale, zeros, self.meta.nbits)
+            else:
+                scale = rs.abs().max(dim=1).values.clamp(min=1e-5).div(q_max)
+                zeros = None
+                quant = quant_sym(rs, scale, self.meta.nbits)
+
+        # For 4 bits and below, two quantized values share one stored int8, halving
+        # the cache bytes; odd group sizes keep the unpacked layout.
+        packed = self.meta.nbits <= 4 and quant.shape[-1] % 2 == 0
+        if packed:
+            quant = pack_int4(quant)
+
+        return VanillaQuantizedTensor(quant, scale, zeros, tensor.shape, axis, self.meta, packed=packed)
@@ -8,13 +8,21 @@ import optuna
 import lm_eval
 from lm_eval.models.huggingface_quant import HFLM_Quant
 import logging
+import os
 import sys
+import json
+import hashlib
+import sqlite3
+import functools
+from dataclasses import dataclass
 
 # For reproducibility
 random.seed(0)
 torch.manual_seed(0)
 CACHE_DIR = "./models_storage"
 
+logger = logging.getLogger("kvtuner")
+
 
 
 LAYER_GROUPING_CONFIG = {
@@ -106,6 +114,14 @@ SPECIAL_LAYERS = {
 }
 
 
+# Hash the special-layer tuples once at import: any membership test against them
+# is O(1) on a frozenset instead of a linear scan over tuples of up to 52 layers.
+SPECIAL_LAYERS = {
+    model_name: {scheme: {frozenset(layers): template for layers, template in special.items()} for scheme, special in schemes.items()}
+    for model_name, schemes in SPECIAL_LAYERS.items()
+}
+
+
 TOT_LAYER = {
     'Meta-Llama-3.1-8B-Instruct': 32,
     'Mistral-7B-Instruct-v0.3': 32,
@@ -128,13 +144,15 @@ device = None
 
 quant_scheme = None
 max_per_layer_scale = None
+eval_wbits = 16
+single_device = False # pin the evaluator to `device` instead of sharding with accelerate
 
-current_layer_grouping = []
-current_special_layers = {}
-current_grouping_quant_template = []
-current_tot_layers = -1
 debug_constraint = False
 
+lm = None # persistent HFLM_Quant evaluator, loaded once in __main__
+eval_cache = None # sqlite connection, opened in __main__ beside the optuna db
+_eval_cache_mem = {} # in-process mirror, avoids hitting sqlite for repeat trials
+
 def parse_args(args=None):
     parser = argparse.ArgumentParser()
     # parser.add_argument('--model_name', type=str, default="meta-llama/Llama-2-7b-hf")
@@ -153,11 +171,30 @@ def parse_args(args=None):
     parser.add_argument('--num_fewshots', type=int, default=4)
     parser.add_argument('--max_per_layer_scale', type=str, default='8')
     parser.add_argument('--n_trials', type=int, default=100)
+    parser.add_argument('--sampler', type=str, default="nsga2") # nsga2 or tpe
+    parser.add_argument('--eval_wbits', type=int, default=16) # 4 to evaluate with int4 weights
+    parser.add_argument('--parallel_workers', type=int, default=1) # one search process per GPU
     parser.add_argument('--device', type=str, default="cuda")
+    parser.add_argument('--single_device', default=False, action='store_true') # pin the model to one GPU, skip accelerate hooks
     parser.add_argument('--debug_constraint', default=False, action='store_true')
+    parser.add_argument('--verbose', default=False, action='store_true')
     return parser.parse_args(args)
 
 
+@dataclass(frozen=True)
+class SearchContext:
+    """Immutable grouping tables for one (model, quant_scheme) search run. Frozen and
+    picklable, so it can be shared with worker processes and rebuilt without state
+    bleeding between reruns."""
+    layer_grouping: tuple # group -> layer ids
+    special_layers: dict # frozenset of layers -> quant template
+    quant_template: tuple # group -> template strings
+    parsed_template: tuple # [group][choice] -> parsed quant config dict
+    group_bits: tuple # [group][choice] -> (nbits_key + nbits_value) * group size
+    choice_radix: tuple # group -> number of template choices, for the code encoding
+    tot_layers: int
+
+
 def parse_quant_config(quant_config: str):
     if len(quant_config) == 3:
         precision = int(quant_config[2])
@@ -169,88 +206,186 @@ def parse_quant_config(quant_config: str):
 def prepare_layer_grouping_config(model_name: str, quant_scheme: str):
     model_name = model_name.split('/')[-1]
     model_name = model_name.replace('-AWQ', '') # Qwen2.5-3B-Instruct-AWQ -> Qwen2.5-3B-Instruct
-    global current_layer_grouping, current_special_layers, current_grouping_quant_template, current_tot_layers
-    current_layer_grouping = LAYER_GROUPING_CONFIG[model_name][quant_scheme]
-    current_special_layers = SPECIAL_LAYERS[model_name][quant_scheme]
-    current_tot_layers = TOT_LAYER[model_name]
-    # check if current_special_layers breaks the current_layer_grouping
-    for group in current_layer_grouping:
-        group_quant_template = STANDARD_KV_QUANT_CONFIG
+    layer_grouping = LAYER_GROUPING_CONFIG[model_name][quant_scheme]
+    special_layers = SPECIAL_LAYERS[model_name][quant_scheme]
+    # flatten the special-layer tuples into one layer -> template map, so each group
+    # is resolved with O(1) lookups instead of rescanning every tuple per layer
+    layer2tpl = {}
+    for special_layer, template in special_layers.items():
+        for layer in special_layer:
+            layer2tpl[layer] = template
+    # check if the special layers break the layer grouping
+    quant_template = []
+    for group in layer_grouping:
+        group_quant_template = layer2tpl.get(group[0], STANDARD_KV_QUANT_CONFIG)
         for layer in group:
-            for special_layer in current_special_layers.keys():
-                if layer in special_layer:
-                    group_quant_template = current_special_layers[special_layer]
-                    for other_layer in group:
-                        if not other_layer in special_layer:
-                            raise ValueError("Special layer {} breaks the layer grouping for model {}, quant scheme {}".format(special_layer, model_name, quant_scheme))
+            if layer2tpl.get(layer, STANDARD_KV_QUANT_CONFIG) is not group_quant_template:
+                raise ValueError("Special layer containing {} breaks the layer grouping for model {}, quant scheme {}".format(layer, model_name, quant_scheme))
         if debug_constraint:
             group_quant_template = [i for i in group_quant_template if i != 'KV2'] # remove KV2
-        current_grouping_quant_template.append(group_quant_template)
+        quant_template.append(group_quant_template)
+    # parse the quant-config strings once here instead of per trial
+    parsed_template = [[parse_quant_config(config) for config in template] for template in quant_template]
+    group_bits = [
+        [(parsed['nbits_key'] + parsed['nbits_value']) * len(group) for parsed in parsed]
+        for group, parsed in zip(layer_grouping, parsed_template)
+    ]
+    return SearchContext(
+        layer_grouping=tuple(tuple(group) for group in layer_grouping),
+        special_layers=special_layers,
+        quant_template=tuple(tuple(template) for template in quant_template),
+        parsed_template=tuple(tuple(parsed) for parsed in parsed_template),
+        group_bits=tuple(tuple(bits) for bits in group_bits),
+        choice_radix=tuple(len(template) for template in quant_template),
+        tot_layers=TOT_LAYER[model_name],
+    )
+
+def eval_cache_key(per_layer_config: dict):
+    # canonical form: one (nbits_key, nbits_value) pair per layer id 0..N-1, so any
+    # two trials that reach the same assignment through different group choices
+    # (or insertion orders) share a key
+    canonical = [(per_layer_config[i]['nbits_key'], per_layer_config[i]['nbits_value']) for i in range(len(per_layer_config))]
+    payload = json.dumps([model, quant_scheme, num_fewshots, limit, eval_wbits, canonical])
+    return hashlib.blake2b(payload.encode()).hexdigest()
+
+def open_eval_cache(study_name: str):
+    connection = sqlite3.connect('{}_evalcache.db'.format(study_name))
+    connection.execute('CREATE TABLE IF NOT EXISTS eval_cache (key TEXT PRIMARY KEY, accuracy REAL)')
+    connection.commit()
+    return connection
 
 def run_gsm8k(per_layer_config: dict, model_name: str, num_fewshots: int, limit: int, device: str):
-    results = lm_eval.simple_evaluate(
-        model='hf-quant',
-        model_args={
-            'pretrained': model_name,
-            'nbits_key': -1,
-            'nbits_value': -1,
-            'residual_length': 32 if quant_scheme == 'per-channel-asym' else 0,
-            'q_group_size': 32 if quant_scheme == 'per-channel-asym' else -1,
-            'asym': True,
-            'axis_key': 1 if quant_scheme == 'per-channel-asym' else 0,
-            'axis_value': 0,
-            'dtype': torch.bfloat16,
-            'force_quant': False,
-            'per_layer_quant': True,
-            'per_layer_config': per_layer_config,
-            'quantilizer': 'vanilla',
-            'device_map': 'auto',
-            'parallelize': True,
-        },
-        tasks=["gsm8k"],
-        num_fewshot=num_fewshots,
-        limit=limit,
-        # device=device
+    # NSGA-II re-proposes identical configs regularly (and always on study resume);
+    # the evaluation dominates the trial cost, so duplicates are served from cache
+    key = eval_cache_key(per_layer_config)
+    if key in _eval_cache_mem:
+        logger.debug('eval cache hit: %s', key)
+        return _eval_cache_mem[key]
+    if eval_cache is not None:
+        row = eval_cache.execute('SELECT accuracy FROM eval_cache WHERE key = ?', (key,)).fetchone()
+        if row is not None:
+            _eval_cache_mem[key] = row[0]
+            logger.debug('eval cache hit: %s', key)
+            return row[0]
+    if lm is not None:
+        # the weights are already on device: swap the per-layer table on the
+        # persistent evaluator and reuse it, bypassing HFLM_Quant re-init
+        lm.per_layer_config = per_layer_config
+        results = lm_eval.simple_evaluate(
+            model=lm,
+            tasks=["gsm8k"],
+            num_fewshot=num_fewshots,
+            limit=limit,
+        )
+    else:
+        results = lm_eval.simple_evaluate(
+            model='hf-quant',
+            model_args={
+                'pretrained': model_name,
+                'nbits_key': -1,
+                'nbits_value': -1,
+                'residual_length': 32 if quant_scheme == 'per-channel-asym' else 0,
+                'q_group_size': 32 if quant_scheme == 'per-channel-asym' else -1,
+                'asym': True,
+                'axis_key': 1 if quant_scheme == 'per-channel-asym' else 0,
+                'axis_value': 0,
+                'dtype': torch.bfloat16,
+                'force_quant': False,
+                'per_layer_quant': True,
+                'per_layer_config': per_layer_config,
+                'quantilizer': 'vanilla',
+                'load_in_4bit': eval_wbits == 4,
+                'device_map': {'': device} if single_device else 'auto',
+                'parallelize': not single_device,
+            },
+            tasks=["gsm8k"],
+            num_fewshot=num_fewshots,
+            limit=limit,
+            # device=device
+        )
+    accuracy = float(results['results']['gsm8k']['exact_match,flexible-extract'])
+    logger.info('gsm8k exact_match,flexible-extract = %s', accuracy)
+    _eval_cache_mem[key] = accuracy
+    if eval_cache is not None:
+        eval_cache.execute('INSERT OR REPLACE INTO eval_cache VALUES (?, ?)', (key, accuracy))
+        eval_cache.commit()
+    return accuracy
+
+
+def build_evaluator(model_name: str):
+    # same arguments simple_evaluate would pass to the 'hf-quant' model type, but
+    # constructed once: from_pretrained plus device sharding costs tens of seconds
+    # per call and does not depend on the trial's per-layer config
+    return HFLM_Quant(
+        pretrained=model_name,
+        nbits_key=-1,
+        nbits_value=-1,
+        residual_length=32 if quant_scheme == 'per-channel-asym' else 0,
+        q_group_size=32 if quant_scheme == 'per-channel-asym' else -1,
+        asym=True,
+        axis_key=1 if quant_scheme == 'per-channel-asym' else 0,
+        axis_value=0,
+        dtype=torch.bfloat16,
+        force_quant=False,
+        per_layer_quant=True,
+        per_layer_config={},
+        quantilizer='vanilla',
+        # int4 weights halve the weight bandwidth of the memory-bound decode and
+        # match the deployment-time setup the searched KV config targets
+        load_in_4bit=eval_wbits == 4,
+        # sharding hooks add per-layer dispatch during decode even on one GPU;
+        # models that fit on a single device run faster pinned to it
+        device_map={'': device} if single_device else 'auto',
+        parallelize=not single_device,
     )
-    print(results['results']['gsm8k']['exact_match,flexible-extract'])
-    return float(results['results']['gsm8k']['exact_match,flexible-extract'])
 
 
-def build_per_layer_config(config_list: int):
+def build_per_layer_config(config_list, ctx: SearchContext):
     per_layer_config = {}
     tot_scale = 0
     for i, config in enumerate(config_list):
-        layers = current_layer_grouping[i]
-        quant_config = parse_quant_config(current_grouping_quant_template[i][config])
-        for layer in layers:
-            per_layer_config[layer] = quant_config
-        tot_scale += (quant_config['nbits_key'] + quant_config['nbits_value']) * len(layers)
-    tot_scale /= current_tot_layers * 2
+        quant_config = ctx.parsed_template[i][config]
+        # every layer of the group shares one interned config dict; fromkeys
+        # fills the mapping in C instead of a per-layer Python loop
+        per_layer_config.update(dict.fromkeys(ctx.layer_grouping[i], quant_config))
+        tot_scale += ctx.group_bits[i][config]
+    tot_scale /= ctx.tot_layers * 2
     return per_layer_config, tot_scale
 
 
-def objective(trial):    
+def objective(trial, ctx: SearchContext):
+    # mixed-radix encoding of all group choices in one parameter: a single
+    # sampler/storage round-trip per trial instead of one per group
+    total = 1
+    for radix in ctx.choice_radix:
+        total *= radix
+    code = trial.suggest_int('code', 0, total - 1)
     config_list = []
-    for i in range(0, len(current_layer_grouping)):
-        config_current_layer = trial.suggest_int('group_{}'.format(i), 0, len(current_grouping_quant_template[i]) - 1)
-        config_list.append(config_current_layer)
+    for radix in ctx.choice_radix:
+        code, choice = divmod(code, radix)
+        config_list.append(choice)
     
-    per_layer_config, tot_scale = build_per_layer_config(config_list)
+    per_layer_config, tot_scale = build_per_layer_config(config_list, ctx)
     
     # Constraints which are considered feasible if less than or equal to zero.
     
     c = tot_scale - max_per_layer_scale
-    print('c = ', c)
+    logger.debug('c = %s', c)
     
     if not debug_constraint:
         trial.set_user_attr('constraints', (c, ))
-    
+        if c > 0:
+            # infeasible regardless of accuracy: tot_scale is a pure function of the
+            # config, so skip the GSM8K run - the sampler only needs the constraint
+            # violation to deprioritize this sample
+            return 0.0, tot_scale
+
     accuracy = run_gsm8k(per_layer_config,  model, num_fewshots, limit, device)
     
     c2 = 0.6 - accuracy
     
     if debug_constraint:
-        print('c2 = ', c2)
+        logger.debug('c2 = %s', c2)
         trial.set_user_attr('constraints', (c, c2))
     
     
@@ -259,29 +394,92 @@ def objective(trial):
 def constraints(trial):
     return trial.user_attrs["constraints"]
 
-if __name__ == "__main__":
-    args = parse_args()
+def run_search(args):
+    global model, quant_scheme, max_per_layer_scale, num_fewshots, limit, device, eval_wbits, single_device, debug_constraint
+    global eval_cache, lm
     model = args.model_name
     quant_scheme = args.quant_scheme
     max_per_layer_scale = float(args.max_per_layer_scale)
     num_fewshots = args.num_fewshots
     limit = args.limit
     device = args.device
+    eval_wbits = args.eval_wbits
+    single_device = args.single_device
     debug_constraint = args.debug_constraint
     
     
+    # per-trial diagnostics go through the logger at DEBUG so the hot path does a
+    # no-op level check instead of a flushed stdout write on every trial
+    sys.stdout.reconfigure(line_buffering=True)
+    logging.basicConfig(stream=sys.stdout, level=logging.DEBUG if args.verbose else logging.INFO)
     optuna.logging.get_logger("optuna").addHandler(logging.StreamHandler(sys.stdout))
     study_name = "OPTUNA_SEARCH_ADAPTIVE_{}_GSM8K_FIRST{}_{}SHOTS_MAXSCALE{}_SCHEME{}".format(model.replace("/", "_"), limit, num_fewshots, max_per_layer_scale, quant_scheme)
-    storage_name = "sqlite:///{}.db".format(study_name)
-    sampler = optuna.samplers.NSGAIISampler(constraints_func=constraints)
-    study = optuna.create_study(directions=["maximize", "minimize"], study_name=study_name, storage=storage_name, sampler=sampler)
+    # journal storage appends to a lock-free log instead of fsyncing a sqlite
+    # transaction per suggest/report, and it does not serialize parallel workers
+    try:
+        from optuna.storages import JournalStorage
+        try:
+            from optuna.storages.journal import JournalFileBackend
+        except ImportError: # renamed from JournalFileStorage in optuna 4
+            from optuna.storages import JournalFileStorage as JournalFileBackend
+        storage_name = JournalStorage(JournalFileBackend("{}.log".format(study_name)))
+    except ImportError: # old optuna without the journal backend
+        storage_name = "sqlite:///{}.db".format(study_name)
+    eval_cache = open_eval_cache(study_name)
+    if args.sampler == 'tpe':
+        # TPE starts exploiting after a few startup trials instead of waiting for a
+        # full NSGA-II generation, which matters when every evaluation costs minutes
+        sampler = optuna.samplers.TPESampler(constraints_func=constraints, multivariate=True, n_startup_trials=10)
+        generation_size = 1 # TPE should see each result before proposing the next
+    else:
+        population_size = 50
+        sampler = optuna.samplers.NSGAIISampler(population_size=population_size, constraints_func=constraints)
+        generation_size = population_size
+    # resume a killed search instead of raising on the existing storage; replayed
+    # trials hit the eval cache, so resuming costs nearly nothing
+    study = optuna.create_study(directions=["maximize", "minimize"], study_name=study_name, storage=storage_name, sampler=sampler, load_if_exists=True)
     
     print(args)
     print('Preparing layer grouping config...')
-    prepare_layer_grouping_config(model, quant_scheme)
-    print('Layer grouping: ', current_layer_grouping)
-    print('Special layers: ', current_special_layers)
-    print('Grouping quant template: ', current_grouping_quant_template)
-    print('Total layers: ', current_tot_layers)
-    
-    study.optimize(objective, n_trials=args.n_trials)
\ No newline at end of file
+    ctx = prepare_layer_grouping_config(model, quant_scheme)
+    print('Layer grouping: ', ctx.layer_grouping)
+    print('Special layers: ', ctx.special_layers)
+    print('Grouping quant template: ', ctx.quant_template)
+    print('Total layers: ', ctx.tot_layers)
+
+    print('Loading evaluation model...')
+    lm = build_evaluator(model)
+
+    # drive the study one NSGA-II generation at a time with ask/tell instead of
+    # study.optimize: the whole population is proposed up front, so anything held
+    # across trials (loaded model, eval cache) is reused for the entire generation
+    objective_fn = functools.partial(objective, ctx=ctx)
+    remaining = args.n_trials
+    while remaining > 0:
+        generation = [study.ask() for _ in range(min(generation_size, remaining))]
+        for trial in generation:
+            accuracy, tot_scale = objective_fn(trial)
+            study.tell(trial, (accuracy, tot_scale))
+        remaining -= len(generation)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.parallel_workers > 1:
+        # one child per GPU: CUDA_VISIBLE_DEVICES is pinned in the parent before
+        # each start so the spawned worker initializes CUDA on its own device,
+        # and the journal storage lets all workers advance the same study
+        import multiprocessing as mp
+        args.n_trials = max(1, args.n_trials // args.parallel_workers)
+        ctx = mp.get_context('spawn')
+        workers = []
+        for rank in range(args.parallel_workers):
+            os.environ['CUDA_VISIBLE_DEVICES'] = str(rank)
+            worker = ctx.Process(target=run_search, args=(args,))
+            worker.start()
+            workers.append(worker)
+        os.environ.pop('CUDA_VISIBLE_DEVICES', None)
+        for worker in workers:
+            worker.join()
+    else:
+        run_search(args)